@@ -0,0 +1,164 @@
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+# every task is a standalone script in its own directory
+for task in ('task01', 'task03', 'task05'):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), task))
+
+import task01
+import task03
+import task05
+
+SIEVE_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+
+# prime tables live here until the interpreter exits
+_table_dir = tempfile.TemporaryDirectory(prefix='prime-tables-')
+
+
+def _build_table(n):
+    path = os.path.join(_table_dir.name, 'build.bin')
+    task03.PrimeTable.build(path, n).close()
+
+
+@functools.lru_cache(maxsize=None)
+def _prime_table(n):
+    # built once per size before the lookups are timed
+    return task03.PrimeTable.build(os.path.join(_table_dir.name, '{}.bin'.format(n)), n)
+
+
+# name -> (callable taking n, default sweep of n)
+BENCHMARKS = {
+    'task01.prime_factor': (lambda n: [task01.prime_factor(n - k) for k in range(100)],
+                            (10 ** 6, 10 ** 12, 2 ** 63)),
+    'task01.prime_factor_many': (lambda n: task01.prime_factor_many(range(n)), SIEVE_SIZES[:-1]),
+    'task03.is_prime': (lambda n: [task03.is_prime(n - k) for k in range(1000)],
+                        (10 ** 4, 10 ** 9, 2 ** 63, 2 ** 100)),
+    'task03.eratosthenes_list': (task03.eratosthenes_list, SIEVE_SIZES),
+    'task03.eratosthenes_set': (task03.eratosthenes_set, SIEVE_SIZES[:-1]),
+    'task03.eratosthenes_bitarray': (task03.eratosthenes_bitarray, SIEVE_SIZES),
+    'task03.eratosthenes_segmented': (lambda n: list(task03.eratosthenes_segmented(n)), SIEVE_SIZES),
+    'task03.eratosthenes_wheel': (task03.eratosthenes_wheel, SIEVE_SIZES),
+    'task03.eratosthenes_parallel': (task03.eratosthenes_parallel, SIEVE_SIZES[2:]),
+    'task03.eratosthenes_parallel_count': (task03.eratosthenes_parallel_count, SIEVE_SIZES[2:]),
+    'task03.prime_count': (task03.prime_count, (10 ** 6, 10 ** 8, 10 ** 10)),
+    'task03.PrimeTable.build': (_build_table, SIEVE_SIZES),
+    'task03.PrimeTable.is_prime': (
+        lambda n: [_prime_table(n).is_prime(n - 1 - k) for k in range(1000)], SIEVE_SIZES),
+    'task03.PrimeTable.prime_count': (
+        lambda n: [_prime_table(n).prime_count(n - 1 - k) for k in range(1000)], SIEVE_SIZES),
+    'task05.is_prime': (lambda n: [task05.is_prime(n - k) for k in range(1000)],
+                        (10 ** 4, 10 ** 9, 2 ** 63, 2 ** 100)),
+    'task05.first_primes_le': (lambda n: task05.PrimeCache().primes_le(n), SIEVE_SIZES),
+}
+
+# run before a benchmark is measured, so that one-off preparation is not timed
+SETUP = {
+    'task03.PrimeTable.is_prime': _prime_table,
+    'task03.PrimeTable.prime_count': _prime_table,
+}
+
+
+def measure(func, n, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(n)
+        timings.append(time.perf_counter() - start_time)
+
+    # a separate run: tracemalloc slows allocation-heavy code down noticeably
+    tracemalloc.start()
+    try:
+        func(n)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'n': n,
+        'repeat': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'peak_memory': peak_memory,
+    }
+
+
+def run(names, repeat, max_n):
+    results = []
+    for name in names:
+        func, sizes = BENCHMARKS[name]
+        for n in sizes:
+            if max_n is not None and n > max_n:
+                continue
+            if name in SETUP:
+                SETUP[name](n)
+            result = measure(func, n, repeat)
+            result['name'] = name
+            results.append(result)
+            print('{:<36} n={:<22} min={:.6f} median={:.6f} peak={}'
+                  .format(name, n, result['min'], result['median'], result['peak_memory']),
+                  file=sys.stderr)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    baseline_results = {(r['name'], r['n']): r for r in baseline['results']}
+    regressions = []
+
+    for result in current['results']:
+        previous = baseline_results.get((result['name'], result['n']))
+        if previous is None or previous['min'] == 0:
+            continue
+        ratio = result['min'] / previous['min']
+        if ratio > 1 + threshold:
+            regressions.append((result['name'], result['n'], ratio))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark prime and factorization routines')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-n', type=int, help='skip sizes above this value')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown of the min time reported as a regression')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        print('Unknown benchmarks: {}'.format(', '.join(unknown)), file=sys.stderr)
+        sys.exit(-1)
+
+    report = run(args.names or list(BENCHMARKS), args.repeat, args.max_n)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), report, args.threshold)
+        for name, n, ratio in regressions:
+            print('regression: {} n={} is {:.2f}x slower'.format(name, n, ratio), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
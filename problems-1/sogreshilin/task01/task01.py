@@ -1,30 +1,179 @@
+import math
+import random
+from array import array
 import unittest
 
-from math import sqrt, ceil
+
+def _small_primes(upper_bound):
+    sieve = bytearray([1]) * upper_bound
+    sieve[:2] = b'\x00\x00'
+
+    for i in range(2, math.isqrt(upper_bound - 1) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, upper_bound, i)))
+
+    return [i for i in range(upper_bound) if sieve[i]]
+
+
+SMALL_PRIMES_BOUND = 1 << 10
+SMALL_PRIMES = _small_primes(SMALL_PRIMES_BOUND)
+
+# Jaeschke / Sinclair bases: deterministic for every n < 2^64
+MILLER_RABIN_BASES = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+
+
+def _is_prime(n):
+    if n < 2:
+        return False
+
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    if n < SMALL_PRIMES_BOUND * SMALL_PRIMES_BOUND:
+        return True
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for a in MILLER_RABIN_BASES:
+        a %= n
+        if a == 0:
+            continue
+
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def _pollard_brent(n):
+    if n % 2 == 0:
+        return 2
+
+    while True:
+        y, c, m = random.randrange(1, n), random.randrange(1, n), 128
+        g, r, q = 1, 1, 1
+
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(m, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = math.gcd(q, n)
+                k += m
+            r *= 2
+
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = math.gcd(abs(x - ys), n)
+
+        if g != n:
+            return g
+
+
+def _factor_large(n, factors):
+    if n == 1:
+        return
+
+    if _is_prime(n):
+        factors[n] = factors.get(n, 0) + 1
+        return
+
+    divisor = _pollard_brent(n)
+    _factor_large(divisor, factors)
+    _factor_large(n // divisor, factors)
 
 
 def prime_factor(n):
-    last_possible_factor = ceil(sqrt(n))
+    factors = dict()
 
-    factors = []
-    factor = 2
+    if n < 2:
+        return []
+
+    for p in SMALL_PRIMES:
+        if p * p > n:
+            break
 
-    while factor <= last_possible_factor:
         counter = 0
-        while n % factor == 0:
+        while n % p == 0:
             counter += 1
-            n //= factor
+            n //= p
 
         if counter > 0:
-            factors.append([factor, counter])
-        factor += 1
+            factors[p] = counter
+
+    _factor_large(n, factors)
+
+    return [[factor, counter] for factor, counter in sorted(factors.items())]
+
+
+# multiples crossed off per slice assignment, bounds the temporary fill array
+SPF_BLOCK = 1 << 16
+# batches above this go through prime_factor, the table takes 4 bytes per number
+SPF_TABLE_LIMIT = 10 ** 8
+
+
+def smallest_prime_factors(upper_bound):
+    # spf[n] == 0 marks a prime (or 0 and 1); walking primes from the largest
+    # down lets every slice assignment overwrite with a smaller factor
+    spf = array('I', [0]) * (upper_bound + 1)
+    base_primes = _small_primes(math.isqrt(upper_bound) + 1)
+
+    for p in reversed(base_primes):
+        fill = array('I', [p]) * min(SPF_BLOCK, len(range(p * p, upper_bound + 1, p)))
+        step = SPF_BLOCK * p
+        for start in range(p * p, upper_bound + 1, step):
+            stop = min(start + step, upper_bound + 1)
+            count = len(range(start, stop, p))
+            spf[start:stop:p] = fill if count == len(fill) else fill[:count]
+
+    return spf
+
+
+def _factor_with_table(n, spf):
+    factors = []
 
-    if n > 1:
-        factors.append([n, 1])
+    while n > 1:
+        p = spf[n] or n
+        counter = 0
+        while n % p == 0:
+            counter += 1
+            n //= p
+        factors.append([p, counter])
 
     return factors
 
 
+def prime_factor_many(numbers):
+    numbers = list(numbers)
+    if not numbers:
+        return []
+
+    # a single huge number must not size the table, those are factored one by one
+    table_bound = max((n for n in numbers if n <= SPF_TABLE_LIMIT), default=1)
+    spf = smallest_prime_factors(max(table_bound, 1))
+    return [_factor_with_table(n, spf) if n <= SPF_TABLE_LIMIT else prime_factor(n) for n in numbers]
+
+
 class TestPrimeFactorization(unittest.TestCase):
     def test_prime(self):
         self.assertEqual(prime_factor(13), [[13, 1]])
@@ -45,6 +194,55 @@ class TestPrimeFactorization(unittest.TestCase):
         table_prime = 32_416_190_071
         self.assertEqual(prime_factor(table_prime), [[table_prime, 1]])
 
+    def test_semiprime_64bit(self):
+        p, q = 4_294_967_291, 4_294_967_279
+        self.assertEqual(prime_factor(p * q), [[q, 1], [p, 1]])
+
+    def test_prime_power(self):
+        p = 1_000_003
+        self.assertEqual(prime_factor(p ** 3 * 7), [[7, 1], [p, 3]])
+
+    def test_max_64bit(self):
+        factors = [[3, 1], [5, 1], [17, 1], [257, 1], [641, 1], [65537, 1], [6700417, 1]]
+        self.assertEqual(prime_factor(2 ** 64 - 1), factors)
+
+    def test_matches_trial_division(self):
+        for n in range(2, 5000):
+            product = 1
+            for factor, counter in prime_factor(n):
+                self.assertTrue(all(factor % d for d in range(2, math.isqrt(factor) + 1)))
+                product *= factor ** counter
+            self.assertEqual(product, n)
+
+
+class TestPrimeFactorizationMany(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(prime_factor_many([]), [])
+
+    def test_zero_one(self):
+        self.assertEqual(prime_factor_many([0, 1]), [[], []])
+
+    def test_matches_prime_factor(self):
+        numbers = list(range(10_000)) + [2 ** 16 + 1, 3 ** 10, 99_991 * 7]
+        expected = [prime_factor(n) for n in numbers]
+        self.assertEqual(prime_factor_many(iter(numbers)), expected)
+
+    def test_table_is_compact(self):
+        spf = smallest_prime_factors(1000)
+        self.assertEqual(spf.itemsize, 4)
+        self.assertEqual(spf[997], 0)
+        self.assertEqual(spf[3 * 331], 3)
+
+    def test_large_number_skips_table(self):
+        numbers = [12, 10 ** 12 + 39, 2 ** 61 - 1]
+        expected = [prime_factor(n) for n in numbers]
+        self.assertEqual(prime_factor_many(numbers), expected)
+
+    def test_blocks_cover_table(self):
+        spf = smallest_prime_factors(3 * SPF_BLOCK * 2 + 5)
+        self.assertEqual(spf[2 * (3 * SPF_BLOCK + 2)], 2)
+        self.assertEqual(spf[3 * (2 * SPF_BLOCK + 1)], 3)
+
 
 if __name__ == "__main__":
     unittest.main()
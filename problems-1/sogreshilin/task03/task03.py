@@ -1,15 +1,85 @@
+import collections
+import itertools
 import math
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
 import bitarray
-import time
 import unittest
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 
-def is_prime(n):
-    if n < 2:
+SMALL_PRIMES_BOUND = 1 << 16
+
+
+def _small_prime_mask(upper_bound):
+    sieve = bytearray([1]) * upper_bound
+    sieve[:2] = bytes(2)
+    for i in range(2, math.isqrt(upper_bound - 1) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, upper_bound, i)))
+
+    mask = bytearray(upper_bound // 8)
+    for i in itertools.compress(range(upper_bound), sieve):
+        mask[i >> 3] |= 1 << (i & 7)
+    return bytes(mask)
+
+
+SMALL_PRIME_MASK = _small_prime_mask(SMALL_PRIMES_BOUND)
+PREFILTER_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61)
+# Jaeschke / Sinclair bases: deterministic for every n < 2^64
+MILLER_RABIN_BASES = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+MILLER_RABIN_ROUNDS = 24
+
+# which path answered each is_prime call
+is_prime_paths = collections.Counter()
+
+
+def _miller_rabin(n, bases):
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for a in bases:
+        a %= n
+        if a == 0:
+            continue
+
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def is_prime(n, rounds=MILLER_RABIN_ROUNDS):
+    if n < SMALL_PRIMES_BOUND:
+        is_prime_paths['bitmask'] += 1
+        return n >= 0 and bool(SMALL_PRIME_MASK[n >> 3] >> (n & 7) & 1)
+
+    if any(n % p == 0 for p in PREFILTER_PRIMES):
+        is_prime_paths['prefilter'] += 1
         return False
 
-    last_factor = int(math.sqrt(n))
-    return all(n % i for i in range(2, last_factor + 1))
+    if n < 1 << 64:
+        is_prime_paths['miller_rabin'] += 1
+        return _miller_rabin(n, MILLER_RABIN_BASES)
+
+    is_prime_paths['miller_rabin_probabilistic'] += 1
+    return _miller_rabin(n, [random.randrange(2, n - 1) for _ in range(rounds)])
 
 
 def eratosthenes_list(upper_bound):
@@ -17,7 +87,7 @@ def eratosthenes_list(upper_bound):
 
     for i in range(2, int(math.sqrt(upper_bound)) + 1):
         if sieve[i]:
-            for j in range(i * 2, upper_bound, i):
+            for j in range(i * i, upper_bound, i):
                 sieve[j] = False
 
     return [i for i in range(2, upper_bound) if sieve[i]]
@@ -27,7 +97,7 @@ def eratosthenes_set(upper_bound):
     sieve = set(range(2, upper_bound))
 
     for i in range(2, int(math.sqrt(upper_bound)) + 1):
-        for j in range(i * 2, upper_bound, i):
+        for j in range(i * i, upper_bound, i):
             if j in sieve: sieve.remove(j)
 
     return sieve
@@ -39,16 +109,268 @@ def eratosthenes_bitarray(upper_bound):
 
     for i in range(2, int(math.sqrt(upper_bound)) + 1):
         if bits[i]:
-            for j in range(i * 2, upper_bound, i):
+            for j in range(i * i, upper_bound, i):
                 bits[j] = False
 
     return [i for i in range(2, upper_bound) if bits[i]]
 
 
-def measure_time(func, *args, **kwargs):
-    start_time = time.time()
-    func(*args, **kwargs)
-    return time.time() - start_time
+WHEEL = (1, 7, 11, 13, 17, 19, 23, 29)
+WHEEL_INDEX = {r: i for i, r in enumerate(WHEEL)}
+
+
+def _wheel_bits(upper_bound):
+    # bit 8 * k + i stands for 30 * k + WHEEL[i]: only numbers coprime to 30 are stored
+    bits = bitarray.bitarray(8 * -(-upper_bound // 30), endian='big')
+    bits.setall(True)
+    if upper_bound > 0:
+        bits[0] = False
+
+    for i in range(8 * (math.isqrt(max(upper_bound - 1, 0)) // 30 + 1)):
+        p = 30 * (i >> 3) + WHEEL[i & 7]
+        if p * p >= upper_bound:
+            break
+        if not bits[i]:
+            continue
+
+        for r in WHEEL:
+            multiple = p * (p + (r - p) % 30)
+            start = 8 * (multiple // 30) + WHEEL_INDEX[multiple % 30]
+            bits[start::8 * p] = False
+
+    for i, r in enumerate(WHEEL):
+        if len(bits) and 30 * (len(bits) // 8 - 1) + r >= upper_bound:
+            bits[len(bits) - 8 + i] = False
+
+    return bits
+
+
+def eratosthenes_wheel(upper_bound):
+    bits = _wheel_bits(upper_bound)
+
+    primes = [p for p in (2, 3, 5) if p < upper_bound]
+    for i, r in enumerate(WHEEL):
+        primes.extend(itertools.compress(range(r, upper_bound, 30), bits[i::8]))
+
+    return sorted(primes)
+
+
+# roughly the size of a per-core L2 cache, one byte per number
+SEGMENT_SIZE = 256 * 1024
+
+
+def eratosthenes_segmented(upper_bound, segment_size=SEGMENT_SIZE):
+    if upper_bound <= 2:
+        return
+
+    base_primes = eratosthenes_list(math.isqrt(upper_bound - 1) + 1)
+
+    for low in range(0, upper_bound, segment_size):
+        high = min(low + segment_size, upper_bound)
+        segment = bytearray([1]) * (high - low)
+
+        for p in base_primes:
+            if p * p >= high:
+                break
+            start = max(p * p, (low + p - 1) // p * p) - low
+            segment[start::p] = bytes(len(range(start, high - low, p)))
+
+        if low == 0:
+            segment[:2] = bytes(2)
+
+        yield from itertools.compress(range(low, high), segment)
+
+
+def _sieve_shared_segment(shm_name, base_primes, low, high):
+    # packs [low, high) into the shared bitmap; low is a multiple of 8,
+    # so every worker owns whole bytes and no locking is needed
+    bits = bitarray.bitarray(high - low, endian='big')
+    bits.setall(True)
+
+    for p in base_primes:
+        if p * p >= high:
+            break
+        start = max(p * p, (low + p - 1) // p * p) - low
+        bits[start::p] = False
+
+    if low == 0:
+        bits[:2] = False
+
+    packed = bits.tobytes()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        shm.buf[low // 8:low // 8 + len(packed)] = packed
+    finally:
+        shm.close()
+
+
+def _parallel_bitmap(upper_bound, workers, segment_size):
+    segment_size = -(-segment_size // 8) * 8
+    base_primes = eratosthenes_list(math.isqrt(upper_bound - 1) + 1)
+
+    shm = shared_memory.SharedMemory(create=True, size=-(-upper_bound // 8))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_sieve_shared_segment, shm.name, base_primes,
+                                       low, min(low + segment_size, upper_bound))
+                       for low in range(0, upper_bound, segment_size)]
+            for future in futures:
+                future.result()
+
+        bits = bitarray.bitarray(endian='big')
+        bits.frombytes(bytes(shm.buf))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return bits[:upper_bound]
+
+
+def eratosthenes_parallel(upper_bound, workers=None, segment_size=8 * SEGMENT_SIZE):
+    if upper_bound <= 2:
+        return []
+
+    bits = _parallel_bitmap(upper_bound, workers, segment_size)
+    return [2] + list(itertools.compress(range(3, upper_bound, 2), bits[3::2]))
+
+
+def eratosthenes_parallel_count(upper_bound, workers=None, segment_size=8 * SEGMENT_SIZE):
+    if upper_bound <= 2:
+        return 0
+
+    return _parallel_bitmap(upper_bound, workers, segment_size).count()
+
+
+def prime_count(x):
+    # Lucy_Hedgehog: small[v] = pi(v) for v <= sqrt(x), large[i] = pi(x // i);
+    # both start as "numbers in [2, v]" and lose the multiples of every prime p,
+    # O(x^(3/4)) time and O(sqrt(x)) memory
+    if x < 2:
+        return 0
+
+    r = math.isqrt(x)
+    small = [max(v - 1, 0) for v in range(r + 1)]
+    large = [0] + [x // i - 1 for i in range(1, r + 1)]
+
+    for p in range(2, r + 1):
+        if small[p] == small[p - 1]:
+            continue
+
+        sp = small[p - 1]
+        p2 = p * p
+        lim = min(r, x // p2)
+        mid = min(lim, r // p)
+
+        # large must be updated first: it reads the old values of small
+        large[1:mid + 1] = [a - b + sp for a, b in zip(large[1:mid + 1], large[p::p])]
+        large[mid + 1:lim + 1] = [large[i] - small[x // (i * p)] + sp for i in range(mid + 1, lim + 1)]
+        if p2 <= r:
+            small[p2:] = [small[v] - small[v // p] + sp for v in range(p2, r + 1)]
+
+    return large[1]
+
+
+PRIME_TABLE_MAGIC = b'PRIMETBL'
+PRIME_TABLE_VERSION = 1
+# magic, version, wheel modulus, bound, bytes per index block
+PRIME_TABLE_HEADER = struct.Struct('<8sIIQQ')
+PRIME_TABLE_BLOCK_BYTES = 64
+
+
+class PrimeTable:
+    # file layout: header, block-popcount index (little-endian uint64 count of
+    # primes before each block), then the mod-30 wheel bitmap, one byte per 30 numbers
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < PRIME_TABLE_HEADER.size:
+                raise ValueError('Truncated prime table: {}'.format(path))
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, wheel, self.bound, self._block_bytes = \
+            PRIME_TABLE_HEADER.unpack_from(self._mmap)
+        if magic != PRIME_TABLE_MAGIC or version != PRIME_TABLE_VERSION or wheel != 30 \
+                or self._block_bytes == 0:
+            self._mmap.close()
+            raise ValueError('Unsupported prime table: {}'.format(path))
+
+        bitmap_size = -(-self.bound // 30)
+        block_count = -(-bitmap_size // self._block_bytes)
+        index_start = PRIME_TABLE_HEADER.size
+        self._bitmap_start = index_start + 8 * block_count
+        if len(self._mmap) < self._bitmap_start + bitmap_size:
+            self._mmap.close()
+            raise ValueError('Truncated prime table: {}'.format(path))
+
+        self._index = memoryview(self._mmap)[index_start:self._bitmap_start].cast('Q')
+        if sys.byteorder != 'little':
+            self._index.release()
+            self._index = array('Q', self._mmap[index_start:self._bitmap_start])
+            self._index.byteswap()
+
+    @classmethod
+    def build(cls, path, upper_bound, block_bytes=PRIME_TABLE_BLOCK_BYTES):
+        bits = _wheel_bits(upper_bound)
+        block_bits = 8 * block_bytes
+
+        index = array('Q')
+        total = 0
+        for start in range(0, len(bits), block_bits):
+            index.append(total)
+            total += bits.count(1, start, start + block_bits)
+        if sys.byteorder != 'little':
+            index.byteswap()
+
+        with open(path, 'wb') as file:
+            file.write(PRIME_TABLE_HEADER.pack(PRIME_TABLE_MAGIC, PRIME_TABLE_VERSION, 30,
+                                               upper_bound, block_bytes))
+            file.write(index.tobytes())
+            file.write(bits.tobytes())
+
+        return cls(path)
+
+    def close(self):
+        if isinstance(self._index, memoryview):
+            self._index.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _check_bound(self, n):
+        if n >= self.bound:
+            raise ValueError('{} is out of the table bound {}'.format(n, self.bound))
+
+    def is_prime(self, n):
+        self._check_bound(n)
+        if n < 7:
+            return n in (2, 3, 5)
+
+        i = WHEEL_INDEX.get(n % 30)
+        if i is None:
+            return False
+
+        return bool(self._mmap[self._bitmap_start + n // 30] >> (7 - i) & 1)
+
+    def prime_count(self, n):
+        # primes <= n: indexed count up to the block, popcount for the rest
+        self._check_bound(n)
+        if n < 7:
+            return sum(p <= n for p in (2, 3, 5))
+
+        byte, residue = divmod(n, 30)
+        block_start = byte - byte % self._block_bytes
+        count = 3 + self._index[block_start // self._block_bytes]
+
+        whole_bytes = self._mmap[self._bitmap_start + block_start:self._bitmap_start + byte]
+        count += int.from_bytes(whole_bytes, 'big').bit_count()
+
+        last = self._mmap[self._bitmap_start + byte]
+        kept = sum(r <= residue for r in WHEEL)
+        return count + (last >> (8 - kept)).bit_count()
 
 
 class TestEratosthenes(unittest.TestCase):
@@ -67,13 +389,83 @@ class TestEratosthenes(unittest.TestCase):
     def test_bitarray(self):
         self.assertTrue(all(is_prime(n) for n in eratosthenes_bitarray(self.small_n)))
 
+    def test_segmented(self):
+        for n in (0, 1, 2, 3, 4, 100, 1009, self.small_n):
+            self.assertEqual(list(eratosthenes_segmented(n, segment_size=64)), eratosthenes_list(n))
+        self.assertEqual(list(eratosthenes_segmented(self.small_n)), eratosthenes_list(self.small_n))
+
+    def test_wheel(self):
+        for n in range(0, 200):
+            self.assertEqual(eratosthenes_wheel(n), eratosthenes_list(n))
+        self.assertEqual(eratosthenes_wheel(self.small_n), eratosthenes_list(self.small_n))
+
+    def test_parallel(self):
+        for n in (0, 2, 3, 100, 1009, self.small_n):
+            self.assertEqual(eratosthenes_parallel(n, workers=2, segment_size=100), eratosthenes_list(n))
+        self.assertEqual(eratosthenes_parallel(self.small_n), eratosthenes_list(self.small_n))
+
+    def test_parallel_count(self):
+        for n in (0, 2, 3, 100, 1009, self.small_n):
+            self.assertEqual(eratosthenes_parallel_count(n, workers=2, segment_size=100),
+                             len(eratosthenes_list(n)))
+
+    def test_prime_table(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'primes.bin')
+            PrimeTable.build(path, 3001, block_bytes=4).close()
+
+            with PrimeTable(path) as table:
+                self.assertEqual(table.bound, 3001)
+                primes = set(eratosthenes_list(3001))
+                for n in range(3001):
+                    self.assertEqual(table.is_prime(n), n in primes)
+                    self.assertEqual(table.prime_count(n), len(eratosthenes_list(n + 1)))
+
+                with self.assertRaises(ValueError):
+                    table.is_prime(3001)
+
+    def test_prime_table_rejects_foreign_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'primes.bin')
+            with open(path, 'wb') as file:
+                file.write(bytes(PRIME_TABLE_HEADER.size))
+
+            with self.assertRaises(ValueError):
+                PrimeTable(path)
+
+    def test_prime_table_rejects_truncated_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'primes.bin')
+            PrimeTable.build(path, 10 ** 5).close()
+            with open(path, 'rb') as file:
+                data = file.read()
+
+            for size in (0, PRIME_TABLE_HEADER.size - 1, PRIME_TABLE_HEADER.size + 3, len(data) - 1):
+                with open(path, 'wb') as file:
+                    file.write(data[:size])
+                with self.assertRaises(ValueError):
+                    PrimeTable(path)
+
+    def test_is_prime_large(self):
+        self.assertTrue(is_prime(2 ** 61 - 1))
+        self.assertTrue(is_prime(2 ** 89 - 1))
+        self.assertFalse(is_prime(3_215_031_751))  # strong pseudoprime to bases 2, 3, 5, 7
+        self.assertFalse(is_prime((2 ** 61 - 1) * (2 ** 31 - 1)))
+
+    def test_prime_count(self):
+        primes = eratosthenes_list(self.small_n)
+        for x in range(-1, self.small_n, 37):
+            self.assertEqual(prime_count(x), len([p for p in primes if p <= x]))
+        self.assertEqual(prime_count(10 ** 8), 5_761_455)
+
     def test_raises_type_error(self):
         with self.assertRaises(TypeError):
             eratosthenes_list("string_value")
 
     def check_complementary_number_set(self, primes_factory, upper_bound):
+        primes = set(primes_factory(upper_bound))
         for i in range(upper_bound):
-            if i in primes_factory(upper_bound):
+            if i in primes:
                 self.assertTrue(is_prime(i))
             else:
                 self.assertFalse(is_prime(i))
@@ -83,19 +475,9 @@ class TestEratosthenes(unittest.TestCase):
         self.check_complementary_number_set(eratosthenes_list, upper_bound)
         self.check_complementary_number_set(eratosthenes_set, upper_bound)
         self.check_complementary_number_set(eratosthenes_bitarray, upper_bound)
-
-
-def test_time():
-    n = 10_000_000
-    list_time = measure_time(eratosthenes_list, n)
-    set_time = measure_time(eratosthenes_set, n)
-    bitarray_time = measure_time(eratosthenes_bitarray, n)
-    print("Time test results:")
-    print(" - list : {0:.4f}".format(list_time))
-    print(" - set  : {0:.4f}".format(set_time))
-    print(" - bits : {0:.4f}".format(bitarray_time))
+        self.check_complementary_number_set(eratosthenes_segmented, upper_bound)
+        self.check_complementary_number_set(eratosthenes_wheel, upper_bound)
 
 
 if __name__ == "__main__":
-    test_time()
     unittest.main()
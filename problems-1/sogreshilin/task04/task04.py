@@ -1,31 +1,437 @@
+import argparse
+import heapq
+import itertools
+import queue
+import shutil
+import sqlite3
 import sys
 import os
-from os.path import isfile, isdir, join
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
+# entries handed to one pool task, keeps the number of in-flight futures bounded
+STAT_BATCH_SIZE = 1024
 
-def ls_size_sorted(dir_path):
-    file_sizes = list()
 
-    for entry in os.listdir(dir_path):
-        path_to_file = join(dir_path, entry)
-        if isfile(path_to_file):
-            file_info = os.stat(path_to_file)
-            file_sizes.append((entry, file_info.st_size))
+def _file_size(entry):
+    # DirEntry.is_file answers from the readdir d_type on most filesystems,
+    # so regular files cost a single stat call
+    try:
+        if entry.is_file():
+            return entry.name, entry.stat().st_size
+    except OSError:
+        pass
+    return None
+
+
+def _batch_file_sizes(entries):
+    return [_file_size(entry) for entry in entries]
+
+
+def _pooled_file_sizes(entries, workers):
+    entries = iter(entries)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        while True:
+            batch = list(itertools.islice(entries, STAT_BATCH_SIZE))
+            if batch:
+                pending.append(executor.submit(_batch_file_sizes, batch))
+            if pending and (not batch or len(pending) >= 2 * workers):
+                yield from pending.pop(0).result()
+            if not batch and not pending:
+                break
+
+
+def _size_key(element):
+    return -element[1], element[0]
+
+
+def ls_size_sorted(dir_path, top=None, workers=None):
+    with os.scandir(dir_path) as entries:
+        if workers:
+            file_sizes = _pooled_file_sizes(entries, workers)
+        else:
+            file_sizes = map(_file_size, entries)
+        file_sizes = filter(None, file_sizes)
+
+        if top is not None:
+            return heapq.nsmallest(top, file_sizes, key=_size_key)
+        return sorted(file_sizes, key=_size_key)
+
+
+class _DirNode:
+    def __init__(self, path, parent):
+        self.path = path
+        self.parent = parent
+        self.size = 0
+        # own scan plus every child directory that has not finished yet
+        self.pending = 1
+
+
+class _TreeWalk:
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._seen_inodes = set()
+        self.finished = queue.Queue()
+
+    def start(self, dir_path):
+        self._submit(_DirNode(dir_path, None))
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, node):
+        self._executor.submit(self._scan, node)
+
+    def _scan(self, node):
+        size = 0
+        children = []
+
+        try:
+            with os.scandir(node.path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            children.append(_DirNode(entry.path, node))
+                            continue
+                        info = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    if info.st_nlink > 1:
+                        key = (info.st_dev, info.st_ino)
+                        with self._lock:
+                            if key in self._seen_inodes:
+                                continue
+                            self._seen_inodes.add(key)
+                    size += info.st_size
+        except OSError:
+            pass
+
+        with self._lock:
+            node.size += size
+            node.pending += len(children)
+        for child in children:
+            self._submit(child)
+        self._finish(node)
+
+    def _finish(self, node):
+        # a directory is done once its own scan and all of its subdirectories are
+        while node is not None:
+            with self._lock:
+                node.pending -= 1
+                if node.pending > 0:
+                    return
+                if node.parent is not None:
+                    node.parent.size += node.size
+
+            self.finished.put((node.path, node.size))
+            if node.parent is None:
+                self.finished.put(None)
+            node = node.parent
+
+
+def disk_usage(dir_path, workers=8):
+    # yields (directory, subtree size) as soon as each subtree is summed;
+    # idle threads pick up any pending directory, symlinks are not followed
+    # and a file with several hard links is counted once
+    os.scandir(dir_path).close()
+
+    walk = _TreeWalk(workers)
+    try:
+        walk.start(dir_path)
+        while True:
+            result = walk.finished.get()
+            if result is None:
+                break
+            yield result
+    finally:
+        walk.close()
+
+
+SEP = os.fsencode(os.sep)
+
+
+def _subtree_bounds(path):
+    # every path strictly below `path` sorts in [low, high) as bytes
+    return path + SEP, path + bytes([SEP[0] + 1])
+
+
+class SizeIndex:
+    # persistent path -> (size, mtime, inode) index in SQLite;
+    # a directory is rescanned only when its own mtime or inode changed, which
+    # catches created, removed and renamed entries but not files rewritten in place,
+    # those keep their old size until something else changes in their directory;
+    # paths are handled and stored as bytes, names that are not valid UTF-8 (KOI8-R,
+    # cp1251) round-trip unchanged and are decoded with os.fsdecode only on output
+
+    # directories modified this recently may still change within the same mtime tick
+    racy_mtime_ns = 2 * 10 ** 9
+
+    # bumped whenever the tables change, an older index is rebuilt from scratch
+    schema_version = 3
+
+    def __init__(self, index_path):
+        self._db = sqlite3.connect(index_path)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+            self._db.executescript('''
+                DROP TABLE IF EXISTS dirs;
+                DROP TABLE IF EXISTS entries;
+                PRAGMA user_version = {};
+            '''.format(self.schema_version))
 
-    return sorted(file_sizes, key=lambda element: (-element[1], element[0]))
+        # dirs.size sums the files of the directory itself that have a single link,
+        # files with several links are summed per query so that every inode counts once
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS dirs (
+                path BLOB PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                dev INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                dir BLOB NOT NULL,
+                name BLOB NOT NULL,
+                is_dir INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                file_size INTEGER,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                nlink INTEGER NOT NULL,
+                PRIMARY KEY (dir, name)
+            );
+            CREATE INDEX IF NOT EXISTS entries_by_size ON entries (dir, file_size DESC, name)
+                WHERE file_size IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS entries_subdirs ON entries (dir, name) WHERE is_dir;
+            CREATE INDEX IF NOT EXISTS entries_linked ON entries (dir) WHERE NOT is_dir AND nlink > 1;
+        ''')
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def refresh(self, dir_path, recursive=False):
+        # returns the bytes path the index stores the directory under
+        dir_path = os.fsencode(os.path.abspath(dir_path))
+        # only the requested directory itself has to be readable
+        os.scandir(dir_path).close()
+
+        with self._db:
+            pending = [dir_path]
+            while pending:
+                path = pending.pop()
+                subdirs = self._refresh_dir(path)
+                if recursive:
+                    pending.extend(subdirs)
+        return dir_path
+
+    def _subdirs(self, path):
+        return [os.path.join(path, name) for (name,) in self._db.execute(
+            'SELECT name FROM entries WHERE dir = ? AND is_dir', (path,))]
+
+    def _refresh_dir(self, path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            # removed since its parent was listed
+            self._forget_tree(path)
+            return []
+
+        row = self._db.execute('SELECT mtime_ns, inode FROM dirs WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == info.st_mtime_ns and row[1] == info.st_ino:
+            return self._subdirs(path)
+
+        rows = []
+        readable = True
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        entry_info = entry.stat(follow_symlinks=False)
+                        file_size = None
+                        if entry.is_file():
+                            file_size = entry.stat().st_size
+                    except OSError:
+                        continue
+                    rows.append((path, entry.name, is_dir, entry_info.st_size, file_size,
+                                 entry_info.st_mtime_ns, entry_info.st_ino, entry_info.st_nlink))
+        except OSError:
+            # unreadable, indexed as empty and rescanned on every refresh
+            rows = []
+            readable = False
+
+        old_subdirs = {os.path.basename(subdir) for subdir in self._subdirs(path)}
+        for name in old_subdirs - {row[1] for row in rows if row[2]}:
+            self._forget_tree(os.path.join(path, name))
+
+        mtime_ns = info.st_mtime_ns
+        if not readable or time.time_ns() - mtime_ns < self.racy_mtime_ns:
+            mtime_ns = -1
+        size = sum(row[3] for row in rows if not row[2] and row[7] <= 1)
+
+        self._db.execute('DELETE FROM entries WHERE dir = ?', (path,))
+        self._db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                         (path, mtime_ns, info.st_ino, info.st_dev, size))
+
+        return [os.path.join(path, row[1]) for row in rows if row[2]]
+
+    def _forget_tree(self, path):
+        low, high = _subtree_bounds(path)
+        for table, column in (('dirs', 'path'), ('entries', 'dir')):
+            self._db.execute('DELETE FROM {0} WHERE {1} = ? OR ({1} >= ? AND {1} < ?)'
+                             .format(table, column), (path, low, high))
+
+    def ls_size_sorted(self, dir_path, top=None):
+        dir_path = self.refresh(dir_path)
+        query = ('SELECT name, file_size FROM entries WHERE dir = ? AND file_size IS NOT NULL '
+                 'ORDER BY file_size DESC, name')
+        if top is not None:
+            rows = self._db.execute(query + ' LIMIT ?', (dir_path, top))
+        else:
+            rows = self._db.execute(query, (dir_path,))
+        return [(os.fsdecode(name), size) for name, size in rows]
+
+    def subtree_sizes(self, dir_path):
+        dir_path = self.refresh(dir_path, recursive=True)
+        low, high = _subtree_bounds(dir_path)
+        in_tree = '({0} = ? OR ({0} >= ? AND {0} < ?))'
+        bounds = (dir_path, low, high)
+
+        # per-directory totals are kept up to date by refresh, only hard links are summed here
+        sizes = dict(self._db.execute(
+            'SELECT path, size FROM dirs WHERE ' + in_tree.format('path'), bounds))
+
+        seen_inodes = set()
+        for path, dev, inode, size in self._db.execute(
+                'SELECT dir, dev, entries.inode, entries.size FROM entries INDEXED BY entries_linked '
+                'JOIN dirs ON dirs.path = entries.dir '
+                'WHERE NOT is_dir AND nlink > 1 AND ' + in_tree.format('dir'), bounds):
+            if (dev, inode) not in seen_inodes:
+                seen_inodes.add((dev, inode))
+                sizes[path] += size
+
+        for path in sorted(sizes, key=lambda p: p.count(SEP), reverse=True):
+            if path != dir_path:
+                sizes[os.path.dirname(path)] += sizes[path]
+
+        return sorted(((os.fsdecode(path), size) for path, size in sizes.items()), key=_size_key)
+
+
+class TestSizeIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tree = os.path.join(self.root, 'tree')
+        os.makedirs(os.path.join(self.tree, 'a', 'b'))
+        os.makedirs(os.path.join(self.tree, 'c'))
+        self._write(os.path.join(self.tree, 'a', 'f'), 10)
+        self._write(os.path.join(self.tree, 'a', 'b', 'g'), 100)
+        self.index = SizeIndex(os.path.join(self.root, 'index.db'))
+        # the test tree was just written, trust its mtimes anyway
+        self.index.racy_mtime_ns = 0
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root)
+
+    @staticmethod
+    def _write(path, size):
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+
+    def test_subtree_sizes(self):
+        sizes = dict(self.index.subtree_sizes(self.tree))
+        self.assertEqual(sizes[self.tree], 110)
+        self.assertEqual(sizes[os.path.join(self.tree, 'a')], 110)
+        self.assertEqual(sizes[os.path.join(self.tree, 'a', 'b')], 100)
+        self.assertEqual(sizes[os.path.join(self.tree, 'c')], 0)
+
+    def test_unchanged_rerun_does_not_rescan(self):
+        expected = self.index.subtree_sizes(self.tree)
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(self.index.subtree_sizes(self.tree), expected)
+        # only the readability check of the requested directory
+        self.assertEqual(scandir.call_count, 1)
+
+    def test_removed_subdirectory_is_forgotten(self):
+        self.index.subtree_sizes(self.tree)
+        shutil.rmtree(os.path.join(self.tree, 'a', 'b'))
+        self.index.racy_mtime_ns = SizeIndex.racy_mtime_ns
+
+        sizes = dict(self.index.subtree_sizes(self.tree))
+        self.assertNotIn(os.path.join(self.tree, 'a', 'b'), sizes)
+        self.assertEqual(sizes[self.tree], 10)
+
+    def test_hard_links_counted_once(self):
+        os.link(os.path.join(self.tree, 'a', 'b', 'g'), os.path.join(self.tree, 'c', 'g2'))
+        sizes = dict(self.index.subtree_sizes(self.tree))
+        self.assertEqual(sizes[self.tree], 110)
+        self.assertEqual(sizes[os.path.join(self.tree, 'a')] + sizes[os.path.join(self.tree, 'c')], 110)
+
+    def test_names_that_are_not_utf8(self):
+        name = os.fsdecode(b'\xe6\xd9\xd7.txt')
+        self._write(os.path.join(os.fsencode(self.tree), b'\xe6\xd9\xd7.txt'), 5)
+
+        self.assertEqual(self.index.ls_size_sorted(self.tree), [(name, 5)])
+        self.assertEqual(dict(self.index.subtree_sizes(self.tree))[self.tree], 115)
+
+    def test_ls_size_sorted(self):
+        self._write(os.path.join(self.tree, 'big'), 50)
+        self._write(os.path.join(self.tree, 'small'), 1)
+        self.assertEqual(self.index.ls_size_sorted(self.tree), [('big', 50), ('small', 1)])
+        self.assertEqual(self.index.ls_size_sorted(self.tree, top=1), [('big', 50)])
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(description='List files of a directory sorted by size')
+    parser.add_argument('dir_path', nargs='?')
+    parser.add_argument('--top', type=int, help='print only the K largest entries')
+    parser.add_argument('--workers', type=int,
+                        help='stat files from a thread pool, helps on high-latency filesystems')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='total sizes per subtree, printing directories as they are summed')
+    parser.add_argument('--index', help='SQLite index file reused between runs, '
+                                        'only changed directories are rescanned')
+    args = parser.parse_args()
+
+    if args.dir_path is None:
         print("Directory name was not found", file=sys.stderr)
         sys.exit(-1)
 
-    dir_path = sys.argv[1]
     max_filename_len = 20
 
     try:
-        for filename, size in ls_size_sorted(dir_path):
-            print(filename.ljust(max_filename_len)[:max_filename_len], size)
+        if args.index:
+            with SizeIndex(args.index) as index:
+                if args.recursive:
+                    for path, size in index.subtree_sizes(args.dir_path)[:args.top]:
+                        print(size, path)
+                else:
+                    for filename, size in index.ls_size_sorted(args.dir_path, top=args.top):
+                        print(filename.ljust(max_filename_len)[:max_filename_len], size)
+
+        elif args.recursive:
+            subtrees = disk_usage(args.dir_path, workers=args.workers or 8)
+            if args.top is not None:
+                subtrees = heapq.nsmallest(args.top, subtrees, key=_size_key)
+            for path, size in subtrees:
+                print(size, path, flush=True)
+
+        else:
+            for filename, size in ls_size_sorted(args.dir_path, top=args.top, workers=args.workers):
+                print(filename.ljust(max_filename_len)[:max_filename_len], size)
 
     except Exception as exception:
         print(exception, file=sys.stderr)
@@ -1,16 +1,122 @@
+import bisect
+import collections
+import itertools
 import math
+import random
+import threading
 import unittest
 
 
-def is_prime(n):
-    if n < 2:
+SMALL_PRIMES_BOUND = 1 << 16
+
+
+def _small_prime_mask(upper_bound):
+    sieve = bytearray([1]) * upper_bound
+    sieve[:2] = bytes(2)
+    for i in range(2, math.isqrt(upper_bound - 1) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, upper_bound, i)))
+
+    mask = bytearray(upper_bound // 8)
+    for i in itertools.compress(range(upper_bound), sieve):
+        mask[i >> 3] |= 1 << (i & 7)
+    return bytes(mask)
+
+
+SMALL_PRIME_MASK = _small_prime_mask(SMALL_PRIMES_BOUND)
+PREFILTER_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61)
+# Jaeschke / Sinclair bases: deterministic for every n < 2^64
+MILLER_RABIN_BASES = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+MILLER_RABIN_ROUNDS = 24
+
+# which path answered each is_prime call
+is_prime_paths = collections.Counter()
+
+
+def _miller_rabin(n, bases):
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for a in bases:
+        a %= n
+        if a == 0:
+            continue
+
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def is_prime(n, rounds=MILLER_RABIN_ROUNDS):
+    if n < SMALL_PRIMES_BOUND:
+        is_prime_paths['bitmask'] += 1
+        return n >= 0 and bool(SMALL_PRIME_MASK[n >> 3] >> (n & 7) & 1)
+
+    if any(n % p == 0 for p in PREFILTER_PRIMES):
+        is_prime_paths['prefilter'] += 1
         return False
-    last_factor = int(math.sqrt(n))
-    return all(n % i for i in range(2, last_factor + 1))
+
+    if n < 1 << 64:
+        is_prime_paths['miller_rabin'] += 1
+        return _miller_rabin(n, MILLER_RABIN_BASES)
+
+    is_prime_paths['miller_rabin_probabilistic'] += 1
+    return _miller_rabin(n, [random.randrange(2, n - 1) for _ in range(rounds)])
+
+
+class PrimeCache:
+    segment_size = 256 * 1024
+
+    def __init__(self):
+        self.primes = []
+        # every prime below `bound` is in `primes`
+        self.bound = 2
+        self._lock = threading.Lock()
+
+    def primes_le(self, n):
+        if n >= self.bound:
+            with self._lock:
+                self._extend(max(n + 1, 2 * self.bound))
+        return self.primes[:bisect.bisect_right(self.primes, n)]
+
+    def _extend(self, upper_bound):
+        if upper_bound <= self.bound:
+            return
+
+        base_bound = math.isqrt(upper_bound - 1) + 1
+        if base_bound > self.bound:
+            self._extend(base_bound)
+
+        for low in range(self.bound, upper_bound, self.segment_size):
+            high = min(low + self.segment_size, upper_bound)
+            segment = bytearray([1]) * (high - low)
+
+            for p in self.primes:
+                if p * p >= high:
+                    break
+                start = max(p * p, (low + p - 1) // p * p) - low
+                segment[start::p] = bytes(len(range(start, high - low, p)))
+
+            self.primes.extend(itertools.compress(range(low, high), segment))
+            self.bound = high
+
+
+_prime_cache = PrimeCache()
 
 
 def first_primes_le(n):
-    return [i for i in range(2, n + 1) if is_prime(i)]
+    return _prime_cache.primes_le(n)
 
 
 class TestPrimes(unittest.TestCase):
@@ -26,6 +132,28 @@ class TestPrimes(unittest.TestCase):
     def test_le_non_prime(self):
         self.assertEqual(first_primes_le(9), [2, 3, 5, 7])
 
+    def test_is_prime_matches_trial_division(self):
+        for n in list(range(-2, 1000)) + list(range(65_000, 72_000)):
+            expected = n >= 2 and all(n % i for i in range(2, math.isqrt(n) + 1))
+            self.assertEqual(is_prime(n), expected)
+
+    def test_is_prime_paths(self):
+        is_prime_paths.clear()
+        is_prime(97)
+        is_prime(2 ** 20)
+        is_prime(2 ** 61 - 1)
+        is_prime(2 ** 127 - 1)
+        self.assertEqual(is_prime_paths, {'bitmask': 1, 'prefilter': 1, 'miller_rabin': 1,
+                                          'miller_rabin_probabilistic': 1})
+
+    def test_cache_extends_incrementally(self):
+        cache = PrimeCache()
+        cache.segment_size = 64
+        for n in (10, 5, 100, 1000, 50, 4000):
+            self.assertEqual(cache.primes_le(n), [i for i in range(2, n + 1)
+                                                  if all(i % d for d in range(2, i))])
+        self.assertGreater(cache.bound, 4000)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,95 @@
+import collections
+import mmap
+import os
+import stat
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# byte histograms of files, shared by the byte-frequency and encoding-detection tasks
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def chunk_histogram(data):
+    if numpy is not None:
+        if not isinstance(data, numpy.ndarray):
+            data = numpy.frombuffer(data, dtype=numpy.uint8)
+        return numpy.bincount(data, minlength=256).tolist()
+
+    # all 256 bytes, like numpy.bincount; Counter walks the bytes in C
+    histogram = [0] * 256
+    for bite, count in collections.Counter(data).items():
+        histogram[bite] = count
+    return histogram
+
+
+def byte_histogram(file, chunk_size=CHUNK_SIZE):
+    histogram = [0] * 256
+
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            break
+        histogram = [a + b for a, b in zip(histogram, chunk_histogram(data))]
+
+    return histogram
+
+
+def _mapped_histogram(mapped, start=0, end=None, chunk_size=CHUNK_SIZE):
+    # `start` and `chunk_size` must be multiples of the page size for madvise
+    end = len(mapped) if end is None else end
+    histogram = [0] * 256
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL, start, end - start)
+
+    for window_start in range(start, end, chunk_size):
+        window_end = min(window_start + chunk_size, end)
+        if numpy is not None:
+            data = numpy.frombuffer(mapped, dtype=numpy.uint8,
+                                    count=window_end - window_start, offset=window_start)
+        else:
+            data = mapped[window_start:window_end]
+        histogram = [a + b for a, b in zip(histogram, chunk_histogram(data))]
+        del data
+
+        # counted pages are not needed again, keep the resident set flat
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            mapped.madvise(mmap.MADV_DONTNEED, window_start, window_end - window_start)
+
+    return histogram
+
+
+def _range_histogram(filename, start, end):
+    with open(filename, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _mapped_histogram(mapped, start, end)
+
+
+def parallel_file_histogram(filename, workers=None):
+    size = os.path.getsize(filename)
+    workers = workers or os.cpu_count()
+    # whole chunks per worker keep every range page-aligned
+    range_size = max(1, -(-size // (workers * CHUNK_SIZE))) * CHUNK_SIZE
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_range_histogram, filename, start, min(start + range_size, size))
+                   for start in range(0, size, range_size)]
+        histogram = [0] * 256
+        for future in futures:
+            histogram = [a + b for a, b in zip(histogram, future.result())]
+
+    return histogram
+
+
+def file_histogram(file):
+    # regular files are memory-mapped, pipes, terminals and empty files are read in chunks
+    info = os.fstat(file.fileno())
+    if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+        return byte_histogram(file)
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return _mapped_histogram(mapped)
@@ -1,36 +1,39 @@
+import argparse
+import os
 import sys
 
+# shared helpers live one level up, every task stays a standalone script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def next_bite(file, size=1024):
-    while True:
-        data = file.read(size)
-        if not data:
-            break
-        for bite in data:
-            yield bite
+from byte_histograms import CHUNK_SIZE, file_histogram, parallel_file_histogram
 
 
-def count_bites(filename):
-    counter = 0
-    bites_count = dict.fromkeys(range(128, 256), 0)
+def count_bites(filename, workers=None):
+    if filename == '-':
+        histogram = file_histogram(sys.stdin.buffer)
+    elif workers and os.path.isfile(filename) and os.path.getsize(filename) > CHUNK_SIZE:
+        histogram = parallel_file_histogram(filename, workers)
+    else:
+        with open(filename, 'rb') as file:
+            histogram = file_histogram(file)
 
-    with open(filename, 'rb') as file:
-        for bite in next_bite(file):
-            if bite >= 128:
-                counter += 1
-                bites_count[bite] += 1
-
-    return counter, bites_count
+    bites_count = {bite: histogram[bite] for bite in range(128, 256)}
+    return sum(bites_count.values()), bites_count
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print('Expected file name as a command line argument. '
+    parser = argparse.ArgumentParser(description='Frequencies of non-ASCII bytes in a file')
+    parser.add_argument('filename', nargs='?')
+    parser.add_argument('--workers', type=int, help='count byte ranges of the file in a process pool')
+    args = parser.parse_args()
+
+    if args.filename is None:
+        print('Expected file name (or - for stdin) as a command line argument. '
               'File name was not found', file=sys.stderr)
         sys.exit(-1)
 
     try:
-        counter, bites_count = count_bites(sys.argv[1])
+        counter, bites_count = count_bites(args.filename, workers=args.workers)
         for key, value in sorted(bites_count.items(), key=lambda element: (-element[1], element[0])):
             print("'{}'[{}] - {:.4f}".format(bytes([key]).decode('koi8-r'), key, value / counter))
 
@@ -1,6 +1,25 @@
+import argparse
 import codecs
+import collections
+import functools
+import io
+import json
+import math
+import multiprocessing
+import os
+import stat
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# shared helpers live one level up, every task stays a standalone script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from byte_histograms import CHUNK_SIZE, chunk_histogram
+
 freqs = {
     'о': 0.10983, 'е': 0.08483, 'а': 0.07998, 'и': 0.07367, 'н': 0.06700,
     'т': 0.06318, 'с': 0.05473, 'р': 0.04746, 'в': 0.04533, 'л': 0.04343,
@@ -12,90 +31,350 @@ freqs = {
 }
 
 russian_encodings = ('koi8-r', 'cp866', 'cp1251', 'iso_8859-5', 'mac_cyrillic')
+# on a tie the earlier encoding wins, so the Russian code pages go first
+candidate_encodings = russian_encodings + ('utf-8', 'koi8-u', 'cp1125')
 alphabet = 'АаБбВвГгДдЕеЁёЖжЗзИиЙйКкЛлМмНнОоПпРрСсТтУуФфХхЦцЧчШшЩщЪъЫыЬьЭэЮюЯя'
 alphabet_lower = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
 
 
-class EncodingStatistics:
-    def __init__(self, encoding_name):
-        self.name = encoding_name
-        self._prepare_char_to_ord()
-        self._stats = dict()
+letters_by_frequency = sorted(alphabet_lower, key=freqs.get, reverse=True)
+expected_freqs = [freqs[letter] for letter in alphabet_lower]
+
+
+@functools.lru_cache(maxsize=None)
+def letter_table(encoding_name):
+    # byte -> index of the letter in `alphabet_lower` it stands for, -1 for other bytes;
+    # multibyte encodings are keyed by the last byte of a letter, on a clash the
+    # more frequent letter keeps the byte
+    table = [-1] * 256
+    for letter in letters_by_frequency:
+        for char in (letter.upper(), letter):
+            bite = char.encode(encoding_name)[-1]
+            if bite >= 128 and table[bite] == -1:
+                table[bite] = alphabet_lower.index(letter)
+    return tuple(table)
+
+
+@functools.lru_cache(maxsize=None)
+def weight_matrix(encodings):
+    # (encodings * letters) x 256 0/1 matrix, one product with a byte histogram
+    # gives the letter counts for every candidate encoding at once
+    matrix = numpy.zeros((len(encodings), len(alphabet_lower), 256))
+    for row, name in enumerate(encodings):
+        for bite, letter in enumerate(letter_table(name)):
+            if letter >= 0:
+                matrix[row, letter, bite] = 1
+    return matrix.reshape(-1, 256)
+
 
-    def _prepare_char_to_ord(self):
-        bites = alphabet.encode(self.name)
-        self._char_to_ord = dict()
-        for i in range(len(alphabet_lower)):
-            self._char_to_ord[alphabet[2 * i + 1]] = (bites[2 * i], bites[2 * i + 1])
+def _histogram_list(bites_count):
+    if isinstance(bites_count, dict):
+        return [bites_count.get(bite, 0) for bite in range(256)]
+    return list(bites_count)
 
-    def update_stats(self, char, count):
-        self._stats[char] = count
 
-    def upper_ord(self, char):
-        return self._char_to_ord[char][0]
+def encoding_distances(bites_count, encodings=candidate_encodings):
+    # squared distance between the expected letter frequencies and the ones
+    # each encoding would give; encodings that see no letters at all get inf
+    histogram = _histogram_list(bites_count)
+
+    if numpy is not None:
+        counts = (weight_matrix(encodings) @ numpy.array(histogram, dtype=float)) \
+            .reshape(len(encodings), len(alphabet_lower))
+        totals = counts.sum(axis=1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            actual = counts / totals[:, None]
+        values = ((actual - numpy.array(expected_freqs)) ** 2).sum(axis=1)
+        values[totals == 0] = math.inf
+        return dict(zip(encodings, values.tolist()))
+
+    distances = dict()
+    for name in encodings:
+        counts = [0] * len(alphabet_lower)
+        for bite, letter in enumerate(letter_table(name)):
+            if letter >= 0:
+                counts[letter] += histogram[bite]
+        total = sum(counts)
+        if total == 0:
+            distances[name] = math.inf
+            continue
+        distances[name] = sum((e - c / total) ** 2 for e, c in zip(expected_freqs, counts))
+
+    return distances
+
+
+def get_closest_encoding(bites_count):
+    distances = encoding_distances(bites_count)
+    return min(distances, key=distances.get)
 
-    def lower_ord(self, char):
-        return self._char_to_ord[char][1]
 
-    def freqs(self):
-        total_symbols = sum(self._stats.values())
-        return {key: self._stats[key] / total_symbols for key in self._stats}
+EncodingGuess = collections.namedtuple('EncodingGuess', 'encoding distance bytes_read')
 
+# relative gap between the best and the second best distance, 1 - best / second;
+# cp1251 and mac_cyrillic differ in a few letters only and rarely part by more than 0.2
+DEFAULT_CONFIDENCE = 0.1
+# high bytes to see before the first decision, a few words are too noisy
+MIN_HIGH_BYTES = 256
+FIRST_CHUNK_SIZE = 4096
+
+
+def _margin(distances):
+    # encodings with the same letter table (koi8-r and koi8-u, cp866 and cp1125)
+    # always tie, so only distinct distances are compared
+    values = sorted(set(distances.values()))
+    if len(values) < 2 or math.isinf(values[0]):
+        return 0.0
+    return 1 - values[0] / values[1]
+
+
+def detect_encoding(file, confidence=DEFAULT_CONFIDENCE, max_bytes=None):
+    # reads growing chunks and stops as soon as the best encoding leads by `confidence`
+    # or `max_bytes` have been read; with confidence=None the whole file is read
+    histogram = [0] * 256
+    bytes_read = 0
+    chunk_size = FIRST_CHUNK_SIZE
 
-def next_bite(file, size=1024):
     while True:
-        data = file.read(size)
+        data = file.read(chunk_size)
         if not data:
             break
-        for bite in data:
-            yield bite
+        bytes_read += len(data)
+        histogram = [a + b for a, b in zip(histogram, chunk_histogram(data))]
+        chunk_size = min(2 * chunk_size, CHUNK_SIZE)
+
+        if max_bytes is not None and bytes_read >= max_bytes:
+            break
+
+        if confidence is not None and sum(histogram[128:]) >= MIN_HIGH_BYTES:
+            distances = encoding_distances(histogram)
+            if _margin(distances) >= confidence:
+                break
+
+    distances = encoding_distances(histogram)
+    best = min(distances, key=distances.get)
+    return EncodingGuess(best, distances[best], bytes_read)
 
 
-def count_bites(filename):
-    bites_count = dict.fromkeys(range(128, 256), 0)
+def guess_encoding(filename, confidence=DEFAULT_CONFIDENCE, max_bytes=None):
+    if filename == '-':
+        return detect_encoding(sys.stdin.buffer, confidence, max_bytes).encoding
 
     with open(filename, 'rb') as file:
-        for bite in next_bite(file):
-            if bite >= 128:
-                bites_count[bite] += 1
+        return detect_encoding(file, confidence, max_bytes).encoding
 
-    return bites_count
 
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'reference.txt')
+# codes of ASCII bytes (spaces, punctuation, latin text) and of high bytes that are
+# not a letter in the encoding, the latter are never seen in Russian text
+BOUNDARY = len(alphabet_lower)
+FOREIGN = BOUNDARY + 1
+BIGRAM_SMOOTHING = 0.1
+SAMPLE_WINDOW_SIZE = 4096
+SAMPLE_WINDOWS = 3
 
-def distance(expected, actual):
-    rv = 0
-    for key in expected:
-        rv += (expected[key] - actual[key]) ** 2
-    return rv
 
+@functools.lru_cache(maxsize=None)
+def bigram_table(encoding_name):
+    # bytes.translate table from bytes to letter codes, plus the lead bytes of
+    # multibyte letters, which are deleted so that letters become adjacent
+    table = bytes(letter if letter >= 0 else BOUNDARY if bite < 128 else FOREIGN
+                  for bite, letter in enumerate(letter_table(encoding_name)))
+    lead_bytes = set()
+    for letter in alphabet_lower:
+        for char in (letter.upper(), letter):
+            lead_bytes.update(char.encode(encoding_name)[:-1])
+    return table, bytes(sorted(lead_bytes))
 
-def get_closest_encoding(bites_count):
-    distances = dict()
 
-    for encoding in [EncodingStatistics(name) for name in russian_encodings]:
-        for key in alphabet_lower:
-            char_count = bites_count[encoding.upper_ord(key)] + bites_count[encoding.lower_ord(key)]
-            encoding.update_stats(key, char_count)
-        distances[encoding.name] = distance(freqs, encoding.freqs())
+@functools.lru_cache(maxsize=None)
+def reference_bigrams():
+    # log P(next letter code | letter code) estimated from the reference text
+    with open(REFERENCE_PATH, encoding='utf-8') as file:
+        text = file.read().lower()
 
-    return min(distances, key=distances.get)
+    size = FOREIGN + 1
+    counts = [[BIGRAM_SMOOTHING] * size for _ in range(size)]
+    codes = [alphabet_lower.index(char) if char in alphabet_lower else BOUNDARY for char in text]
+    for first, second in zip(codes, codes[1:]):
+        counts[first][second] += 1
+
+    return [[math.log(count / sum(row)) for count in row] for row in counts]
+
+
+def _bigram_counts(codes):
+    size = FOREIGN + 1
+    if numpy is not None:
+        array = numpy.frombuffer(codes, dtype=numpy.uint8).astype(numpy.intp)
+        return numpy.bincount(array[:-1] * size + array[1:], minlength=size * size).tolist()
+
+    counts = [0] * (size * size)
+    for (first, second), count in collections.Counter(zip(codes, codes[1:])).items():
+        counts[first * size + second] = count
+    return counts
 
 
-def guess_encoding(filename):
-    bites_count = count_bites(filename)
-    return get_closest_encoding(bites_count)
+def bigram_cross_entropies(windows, encodings=candidate_encodings):
+    # mean -log P over letter bigrams of the windows decoded with every encoding;
+    # pairs of two non-letters say nothing and are skipped
+    log_probs = [p for row in reference_bigrams() for p in row]
+    skipped = BOUNDARY * (FOREIGN + 1) + BOUNDARY
+    entropies = dict()
+
+    for name in encodings:
+        table, lead_bytes = bigram_table(name)
+        counts = [0] * len(log_probs)
+        for window in windows:
+            counts = [a + b for a, b in zip(counts, _bigram_counts(window.translate(table, lead_bytes)))]
+        counts[skipped] = 0
+
+        total = sum(counts)
+        if total == 0:
+            entropies[name] = math.inf
+            continue
+        entropies[name] = -sum(c * p for c, p in zip(counts, log_probs) if c) / total
+
+    return entropies
+
+
+def read_samples(file, window_size=SAMPLE_WINDOW_SIZE, count=SAMPLE_WINDOWS):
+    # head, middle and tail windows of a regular file, the head only of a pipe
+    # or of a stream without a file descriptor (io.BytesIO, wrapped readers)
+    try:
+        info = os.fstat(file.fileno())
+    except (AttributeError, io.UnsupportedOperation):
+        return [file.read(window_size * count)]
+
+    if not stat.S_ISREG(info.st_mode) or info.st_size <= window_size * count:
+        return [file.read(window_size * count)]
+
+    windows = []
+    for i in range(count):
+        file.seek((info.st_size - window_size) * i // (count - 1))
+        windows.append(file.read(window_size))
+    return windows
+
+
+def detect_encoding_sampled(file, window_size=SAMPLE_WINDOW_SIZE, encodings=candidate_encodings):
+    # EncodingGuess.distance is the bigram cross-entropy here, lower is better
+    windows = read_samples(file, window_size)
+    entropies = bigram_cross_entropies(windows, encodings)
+    best = min(entropies, key=entropies.get)
+    return EncodingGuess(best, entropies[best], sum(map(len, windows)))
+
+
+def transcode_to_utf8(source, target, encoding, chunk_size=CHUNK_SIZE):
+    # multibyte sequences may be split between chunks, the incremental decoder
+    # carries them over; bytes that do not decode raise UnicodeDecodeError
+    # instead of turning into U+FFFD, a wrong guess must not pass as a copy
+    decoder = codecs.getincrementaldecoder(encoding)(errors='strict')
+    while True:
+        data = source.read(chunk_size)
+        target.write(decoder.decode(data, final=not data).encode('utf-8'))
+        if not data:
+            break
+
+
+def classify_file(path, confidence=DEFAULT_CONFIDENCE, transcode_suffix=None, sampled=False):
+    try:
+        with open(path, 'rb') as file:
+            if sampled:
+                guess = detect_encoding_sampled(file)
+            else:
+                guess = detect_encoding(file, confidence)
+            # empty, ASCII-only or binary files have no Russian letters in any encoding,
+            # an infinite distance would also not be valid JSON
+            if math.isinf(guess.distance):
+                return {'path': path, 'status': 'undetermined', 'encoding': None,
+                        'distance': None, 'bytes_read': guess.bytes_read}
+
+            result = {'path': path, 'status': 'detected', 'encoding': guess.encoding,
+                      'distance': guess.distance, 'bytes_read': guess.bytes_read}
+
+            if transcode_suffix is not None:
+                file.seek(0)
+                try:
+                    with open(path + transcode_suffix, 'wb') as target:
+                        transcode_to_utf8(file, target, guess.encoding)
+                except UnicodeDecodeError as e:
+                    os.remove(path + transcode_suffix)
+                    result['status'] = 'decode_failed'
+                    result['error'] = str(e)
+                else:
+                    result['transcoded'] = path + transcode_suffix
+
+    except OSError as e:
+        return {'path': path, 'error': str(e)}
+
+    return result
+
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, filenames in os.walk(path):
+                for filename in filenames:
+                    yield os.path.join(dir_path, filename)
+        else:
+            yield path
+
+
+def classify_files(paths, workers=None, confidence=DEFAULT_CONFIDENCE, transcode_suffix=None,
+                   sampled=False):
+    # results come back as soon as they are ready, not in input order
+    classify = functools.partial(classify_file, confidence=confidence,
+                                 transcode_suffix=transcode_suffix, sampled=sampled)
+    files = iter_files(paths)
+    if transcode_suffix:
+        # do not pick up copies written by an earlier run
+        files = (path for path in files if not path.endswith(transcode_suffix))
+
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(classify, files, chunksize=16)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    parser = argparse.ArgumentParser(description='Guess the encoding of Russian text files')
+    parser.add_argument('paths', nargs='*', help='files, or directories in batch mode')
+    parser.add_argument('--batch', action='store_true',
+                        help='classify every file under the paths and print JSON lines')
+    parser.add_argument('--files-from', help='read paths for batch mode from this file, - for stdin')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE)
+    parser.add_argument('--transcode-suffix',
+                        help='in batch mode also write a UTF-8 copy of each file with this suffix')
+    parser.add_argument('--sampled', action='store_true',
+                        help='score letter bigrams of the head, middle and tail of each file only')
+    args = parser.parse_args()
+
+    if args.batch:
+        paths = list(args.paths)
+        if args.files_from:
+            with (sys.stdin if args.files_from == '-' else open(args.files_from)) as listing:
+                paths.extend(line.rstrip('\n') for line in listing if line.strip())
+
+        for result in classify_files(paths, args.workers, args.confidence, args.transcode_suffix,
+                                     args.sampled):
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+        sys.exit(0)
+
+    if len(args.paths) != 1:
         print('Expected file name as a command line argument. '
               'File name was not found', file=sys.stderr)
         sys.exit(-1)
 
-    filename = sys.argv[1]
+    filename = args.paths[0]
     try:
-        guessed_encoding = guess_encoding(filename)
-        print(f'file encoding = {guessed_encoding}')
+        with open(filename, 'rb') as file:
+            if args.sampled:
+                guess = detect_encoding_sampled(file)
+            else:
+                guess = detect_encoding(file, args.confidence)
+        if math.isinf(guess.distance):
+            print(f'file encoding could not be determined, no Russian letters in {guess.bytes_read} bytes')
+            sys.exit(0)
+
+        guessed_encoding = guess.encoding
+        print(f'file encoding = {guessed_encoding} (decided after {guess.bytes_read} bytes)')
         value = input('Do you want to print file? y/n: ')
         if value.lower() == 'y':
             print(codecs.open(filename, encoding=guessed_encoding).read())
@@ -0,0 +1,129 @@
+import math
+import os
+import time
+
+
+# helpers shared by the latency scripts of the task directories
+
+
+def quantile_rank(q, count):
+    # 0-based rank of the smallest of the top (1 - q) share of the samples,
+    # for q = 0.9 it is the top of a min-heap holding the ceil(count / 10) largest values,
+    # the "upper decile" both scripts print
+    top = math.ceil(round(count * (1 - q), 9))
+    return min(max(count - top, 0), count - 1)
+
+
+def chunk_offsets(file, chunk_size):
+    # [start, end) byte ranges of at most about `chunk_size`, every range ends after a newline
+    size = file.seek(0, os.SEEK_END)
+    offsets = [0]
+
+    while offsets[-1] < size:
+        file.seek(offsets[-1] + chunk_size)
+        file.readline()
+        offsets.append(min(file.tell(), size))
+
+    return list(zip(offsets, offsets[1:]))
+
+
+# rolling windows of the follow mode, in seconds
+FOLLOW_WINDOWS = (60, 300, 900)
+
+FOLLOW_POLL_INTERVAL = 0.5
+
+FOLLOW_READ_SIZE = 64 * 1024
+
+
+class RollingWindows:
+    # a ring of per-second aggregates as long as the longest window; `new_aggregate`
+    # builds an empty one with add(value) and merge(other); a slot remembers which
+    # second it holds, so a stale one is replaced on its next write and adding
+    # a value is O(1), a window merges the slots of its last seconds
+
+    def __init__(self, new_aggregate, windows=FOLLOW_WINDOWS):
+        self.windows = windows
+        self._new_aggregate = new_aggregate
+        self._slots = [None] * max(windows)
+        self._seconds = [None] * max(windows)
+
+    def add(self, value, now):
+        second = int(now)
+        index = second % len(self._slots)
+        if self._seconds[index] != second:
+            self._slots[index] = self._new_aggregate()
+            self._seconds[index] = second
+        self._slots[index].add(value)
+
+    def window(self, seconds, now):
+        aggregate = self._new_aggregate()
+        current = int(now)
+        for second in range(current - seconds + 1, current + 1):
+            index = second % len(self._slots)
+            if self._seconds[index] == second:
+                aggregate.merge(self._slots[index])
+        return aggregate
+
+
+def follow_lines(filename, poll_interval=FOLLOW_POLL_INTERVAL):
+    # like `tail -F`: yields complete lines appended after the start, reopens the
+    # name from its beginning once the file was rotated (the name points to another
+    # inode) and rereads it after truncation; yields None whenever it waits for data
+    file = None
+    from_end = True
+    # the line the writer was in the middle of when we started
+    drop_partial = False
+    pending = b''
+
+    try:
+        while True:
+            if file is None:
+                try:
+                    file = open(filename, 'rb')
+                except FileNotFoundError:
+                    from_end = False
+                    yield None
+                    time.sleep(poll_interval)
+                    continue
+                if from_end:
+                    end = file.seek(0, os.SEEK_END)
+                    if end > 0:
+                        file.seek(end - 1)
+                        drop_partial = file.read(1) != b'\n'
+
+            chunk = file.read(FOLLOW_READ_SIZE)
+            if chunk:
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                if drop_partial and lines:
+                    lines.pop(0)
+                    drop_partial = False
+                yield from lines
+                continue
+
+            # the end of the file, check whether it is still the one under the name
+            try:
+                info = os.stat(filename)
+            except FileNotFoundError:
+                info = None
+            current = os.fstat(file.fileno())
+
+            if info is not None and (info.st_dev, info.st_ino) != (current.st_dev, current.st_ino):
+                file.close()
+                file = None
+                from_end = False
+                drop_partial = False
+                pending = b''
+                continue
+
+            if info is not None and info.st_size < file.tell():
+                file.seek(0)
+                drop_partial = False
+                pending = b''
+                continue
+
+            yield None
+            time.sleep(poll_interval)
+    finally:
+        if file is not None:
+            file.close()
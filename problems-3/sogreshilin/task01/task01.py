@@ -1,48 +1,265 @@
-import sys
-import re
+import argparse
+import io
 import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# shared helpers live one level up, every task stays a standalone script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loglines import FOLLOW_WINDOWS, RollingWindows, chunk_offsets, follow_lines, quantile_rank
+
+
+class QuantileSketch:
+    # log-bucketed histogram: a value v goes to bucket ceil(log_gamma(v)), so every
+    # quantile is answered within `relative_accuracy` of a real sample value;
+    # two sketches with the same accuracy merge by adding bucket counts
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets = dict()
+        self._zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value < 0:
+            raise ValueError('Negative value: {}'.format(value))
+
+        if value == 0:
+            self._zero_count += count
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches have different accuracy: {} and {}'
+                             .format(self.relative_accuracy, other.relative_accuracy))
+
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self._zero_count += other._zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = quantile_rank(q, self.count)
+        seen = self._zero_count
+        if rank < seen:
+            return 0
+
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                return 2 * self._gamma ** index / (self._gamma + 1)
+
+        return 2 * self._gamma ** max(self._buckets) / (self._gamma + 1)
+
+
+class LatencyStats:
+    # count, Welford mean / variance, min, max and a quantile sketch of one syscall;
+    # merging two of them gives the statistics of the concatenated samples
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+
+def parse_line(line):
+    # `<syscall>[(args)] <arg> <latency> usec`, None for lines without a valid latency
+    tokens = line.split()
+    if len(tokens) < 3:
+        return None
 
+    try:
+        value = int(tokens[2])
+    except ValueError:
+        return None
+    if value < 0:
+        return None
+
+    return tokens[0].split(b'(')[0].decode(errors='replace'), value
+
+
+def _collect(lines):
+    # the first `open` line is kept apart as (name, value): whether it is the very
+    # first one of the whole file is only known once chunks are put back in order
+    stats = dict()
+    first_open = None
+
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+
+        name, value = parsed
+        if name not in stats:
+            stats[name] = LatencyStats()
+        if first_open is None and line.startswith(b'open'):
+            first_open = name, value
+            continue
+        stats[name].add(value)
+
+    return stats, first_open
+
+
+def collect_stats(file):
+    # ignore very first `open` value, every other sample is counted
+    stats, _ = _collect(file)
+    return stats
+
+
+# bytes of the log handed to one worker, each one returns per-syscall LatencyStats
+PARALLEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _collect_range(filename, start, end):
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        return _collect(io.BytesIO(file.read(end - start)))
 
-def collect_data(file):
-    sum = 0
-    sum_squares = 0
-    count = 0
 
-    pattern = re.compile(b'\d+ usec')
+def collect_stats_parallel(filename, workers=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    with open(filename, 'rb') as file:
+        ranges = chunk_offsets(file, chunk_size)
 
-    # ignore very first value
-    for line in file:
-        if line.startswith(b'open'):
-            break
+    stats = dict()
+    seen_first_open = False
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_collect_range, filename, start, end) for start, end in ranges]
 
-    for line in file:
-        if line.startswith(b'open'):
-            value = int(line.split()[2])
-            sum += value
-            sum_squares += value * value
-            count += 1
+        for future in futures:
+            chunk_stats, first_open = future.result()
+            for name, chunk in chunk_stats.items():
+                stats.setdefault(name, LatencyStats()).merge(chunk)
 
-    return count, sum, sum_squares
+            # only the very first `open` of the whole file is ignored
+            if first_open is not None:
+                if seen_first_open:
+                    name, value = first_open
+                    stats[name].add(value)
+                seen_first_open = True
+
+    return stats
+
+
+def print_windows(stats, now):
+    print(time.strftime('%H:%M:%S'))
+    for name, rolling in sorted(stats.items()):
+        for seconds in rolling.windows:
+            window = rolling.window(seconds, now)
+            if window.count == 0:
+                continue
+            print("{} {:>3}: count = {}, mean = {:.1f}, std = {:.1f}, upper decile = {:.1f}".format(
+                name, '{}m'.format(seconds // 60), window.count,
+                window.mean, window.std, window.quantile(0.9)))
+    print(flush=True)
+
+
+def follow(filename, windows=FOLLOW_WINDOWS, report_interval=1.0):
+    # only lines written after the start are seen, so no value is ignored here
+    stats = dict()
+    next_report = time.monotonic() + report_interval
+
+    for line in follow_lines(filename):
+        now = time.monotonic()
+        parsed = parse_line(line) if line is not None else None
+        if parsed is not None:
+            name, value = parsed
+            if name not in stats:
+                stats[name] = RollingWindows(LatencyStats, windows)
+            stats[name].add(value, now)
+
+        if now >= next_report:
+            print_windows(stats, now)
+            next_report = now + report_interval
+
+
+def print_stats(stats):
+    printed = False
+    for name, syscall_stats in sorted(stats.items()):
+        if syscall_stats.count == 0:
+            continue
+        printed = True
+        print("{}: count = {}".format(name, syscall_stats.count))
+        print("  mean = {}".format(syscall_stats.mean))
+        print("  std  = {}".format(syscall_stats.std))
+        print("  min  = {}, max = {}".format(syscall_stats.min, syscall_stats.max))
+        print("  p50  = {:.1f}, p90 = {:.1f}, p99 = {:.1f}".format(
+            *(syscall_stats.quantile(q) for q in (0.5, 0.9, 0.99))))
+
+    if not printed:
+        print("sample is empty")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(description='Latency statistics of a syscall log')
+    parser.add_argument('filename', nargs='?')
+    parser.add_argument('--workers', type=int, help='parse newline-aligned chunks in a process pool')
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help='keep reading a growing log like tail -F, printing 1m/5m/15m windows')
+    args = parser.parse_args()
+
+    if args.filename is None:
         print("Path to file was not provided", file=sys.stderr)
         sys.exit(-1)
 
-    filename = sys.argv[1]
     try:
-        with open(filename, 'rb') as file:
-            count, sum, sum_squares = collect_data(file)
-
-            if count > 0:
-                mean = sum / count
-                std = math.sqrt((sum_squares - sum * sum / count) / count)
-                print("mean = {}".format(mean))
-                print("std  = {}".format(std))
-
-            else:
-                print("sample is empty")
+        if args.follow:
+            follow(args.filename)
+        elif args.workers:
+            print_stats(collect_stats_parallel(args.filename, args.workers))
+        else:
+            with open(args.filename, 'rb') as file:
+                print_stats(collect_stats(file))
 
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(e, file=sys.stderr)
@@ -1,38 +1,572 @@
+import argparse
+import array
+import bisect
+import gzip
 import heapq
-import sys
+import io
 import math
+import os
+import random
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# shared helpers live one level up, every task stays a standalone script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loglines import FOLLOW_WINDOWS, RollingWindows, chunk_offsets, follow_lines, quantile_rank
+
+# bytes of the log one worker turns into a sketch of its open latencies
+PARALLEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# ranges this short are sorted instead of partitioned further
+SELECT_SORT_SIZE = 16
+
+
+class LogHistogram:
+    # HDR-style histogram of non-negative integers: values below 2 ** (precision_bits + 1)
+    # are counted exactly, larger ones share buckets of 2 ** shift neighbours,
+    # so a quantile is off by at most 2 ** -(precision_bits + 1) of its value
+    # (0.05% by default); memory is at most 2 ** precision_bits buckets per power of two;
+    # mean and std come from exact integer sums
+
+    def __init__(self, precision_bits=10):
+        self.precision_bits = precision_bits
+        self._buckets = dict()
+        self.count = 0
+        self.total = 0
+        self.total_squares = 0
+        self.min = None
+        self.max = None
+
+    def _shift(self, value):
+        return max(value.bit_length() - self.precision_bits - 1, 0)
+
+    def add(self, value, count=1):
+        if value < 0:
+            raise ValueError('Negative value: {}'.format(value))
+
+        shift = self._shift(value)
+        key = value >> shift << shift
+        self._buckets[key] = self._buckets.get(key, 0) + count
+        self.count += count
+        self.total += value * count
+        self.total_squares += value * value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.precision_bits != self.precision_bits:
+            raise ValueError('Histograms have different precision: {} and {}'
+                             .format(self.precision_bits, other.precision_bits))
+        if other.count == 0:
+            return self
+
+        for key, count in other._buckets.items():
+            self._buckets[key] = self._buckets.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return 0.0
+        return math.sqrt((self.count * self.total_squares - self.total ** 2) / self.count ** 2)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = quantile_rank(q, self.count)
+        seen = 0
+        for key in sorted(self._buckets):
+            seen += self._buckets[key]
+            if seen > rank:
+                middle = key + ((1 << self._shift(key)) >> 1)
+                return min(max(middle, self.min), self.max)
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+
+class KllSketch:
+    # KLL sketch: a stack of compactors, an item on level h stands for 2 ** h samples;
+    # a full level is sorted and every other item is promoted, so memory stays
+    # about 3 * k items for any input; the rank of an answer is off by about
+    # 1.65% of count with 99% confidence for k = 200 (error shrinks roughly as 1 / k),
+    # which is too coarse for p99.9 of small samples, use LogHistogram there
+
+    def __init__(self, k=200, c=2 / 3):
+        self.k = k
+        self.c = c
+        self._compactors = []
+        self._size = 0
+        self._max_size = 0
+        self.count = 0
+        self._grow()
+
+    def _capacity(self, height):
+        depth = len(self._compactors) - height - 1
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    def _grow(self):
+        self._compactors.append([])
+        self._max_size = sum(self._capacity(height) for height in range(len(self._compactors)))
+
+    def _compact(self, height):
+        items = self._compactors[height]
+        items.sort()
+        # an odd item stays on its level, so the total weight is exactly count
+        odd = [items.pop()] if len(items) % 2 else []
+        offset = random.getrandbits(1)
+        self._compactors[height + 1].extend(items[offset::2])
+        self._compactors[height] = odd
+
+    def _compress(self):
+        for height in range(len(self._compactors)):
+            if len(self._compactors[height]) >= self._capacity(height):
+                if height + 1 >= len(self._compactors):
+                    self._grow()
+                self._compact(height)
+                self._size = sum(map(len, self._compactors))
+                if self._size < self._max_size:
+                    break
+
+    def add(self, value):
+        self._compactors[0].append(value)
+        self._size += 1
+        self.count += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def merge(self, other):
+        if other.k != self.k or other.c != self.c:
+            raise ValueError('Sketches have different parameters: k = {} and k = {}'
+                             .format(self.k, other.k))
+
+        while len(self._compactors) < len(other._compactors):
+            self._grow()
+        for height, items in enumerate(other._compactors):
+            self._compactors[height].extend(items)
+        self.count += other.count
+        self._size = sum(map(len, self._compactors))
+        while self._size >= self._max_size:
+            self._compress()
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        weighted = sorted((value, 1 << height)
+                          for height, items in enumerate(self._compactors) for value in items)
+        rank = quantile_rank(q, self.count)
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen > rank:
+                return value
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+
+def _hoare_partition(values, lo, hi):
+    # splits values[lo:hi] around values[lo]: everything before the returned index
+    # is <= the pivot, everything from it on is >=, both parts are non-empty
+    pivot = values[lo]
+    i, j = lo - 1, hi
+    while True:
+        i += 1
+        while values[i] < pivot:
+            i += 1
+        j -= 1
+        while values[j] > pivot:
+            j -= 1
+        if i >= j:
+            return j + 1
+        values[i], values[j] = values[j], values[i]
+
+
+def select(values, ranks):
+    # introselect for several 0-based ranks at once, in place: a partition step only
+    # descends into the sides that still hold a wanted rank, a range that took too
+    # many steps is sorted, so the worst case is O(n log n) instead of O(n ** 2)
+    found = dict()
+    pending = [(0, len(values), sorted(set(ranks)), 2 * len(values).bit_length())]
+
+    while pending:
+        lo, hi, wanted, depth = pending.pop()
+        if hi - lo <= SELECT_SORT_SIZE or depth == 0:
+            values[lo:hi] = array.array(values.typecode, sorted(values[lo:hi]))
+            for rank in wanted:
+                found[rank] = values[rank]
+            continue
+
+        # median of three moved to the front as the pivot
+        mid = (lo + hi) // 2
+        _, pivot_index = sorted((values[index], index) for index in (lo, mid, hi - 1))[1]
+        values[lo], values[pivot_index] = values[pivot_index], values[lo]
+
+        split = _hoare_partition(values, lo, hi)
+        left = [rank for rank in wanted if rank < split]
+        right = [rank for rank in wanted if rank >= split]
+        if left:
+            pending.append((lo, split, left, depth - 1))
+        if right:
+            pending.append((split, hi, right, depth - 1))
+
+    return [found[rank] for rank in ranks]
+
+
+class ExactValues:
+    # every sample in a compact array: 4 bytes per value while they fit in 32 bits
+    # (4 GB for 10 ** 9 samples), 8 bytes once a larger one shows up;
+    # order statistics are exact and found in place in one selection pass,
+    # numpy.partition when numpy is installed, pure Python introselect otherwise
+
+    def __init__(self):
+        self._values = array.array('I')
+
+    @property
+    def count(self):
+        return len(self._values)
+
+    def _widen(self):
+        if self._values.typecode != 'q':
+            self._values = array.array('q', self._values)
+
+    def add(self, value):
+        try:
+            self._values.append(value)
+        except OverflowError:
+            self._widen()
+            self._values.append(value)
+
+    def merge(self, other):
+        if other._values.typecode != self._values.typecode:
+            self._widen()
+            other._widen()
+        self._values.extend(other._values)
+        return self
+
+    def quantiles(self, qs):
+        if self.count == 0:
+            return [None] * len(qs)
+
+        ranks = [quantile_rank(q, self.count) for q in qs]
+        if numpy is None:
+            return select(self._values, ranks)
+
+        # a view on the array buffer, partitioned without a copy
+        dtype = numpy.uint32 if self._values.typecode == 'I' else numpy.int64
+        view = numpy.frombuffer(self._values, dtype=dtype)
+        view.partition(sorted(set(ranks)))
+        return [int(view[rank]) for rank in ranks]
 
+    def quantile(self, q):
+        return self.quantiles([q])[0]
 
-def _skip_first_occurrence(file, pattern):
-    for line in file:
-        if line.startswith(pattern):
-            break
+
+ENGINES = {
+    'hdr': LogHistogram,
+    'kll': KllSketch,
+    'exact': ExactValues,
+}
+
+
+def open_log(filename):
+    # binary stream of the log, '-' is stdin, gzip is recognized by its magic bytes
+    file = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+    if file.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=file)
     return file
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('filename was not provided', file=sys.stderr)
-        sys.exit(-1)
+def parse_open(line):
+    # latency of an `open...` line, None for other and for malformed lines
+    if not line.startswith(b'open'):
+        return None
+
+    try:
+        value = int(line.split()[2])
+    except (IndexError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+def _open_values(lines):
+    for line in lines:
+        value = parse_open(line)
+        if value is not None:
+            yield value
+
+
+def collect(lines, engine='hdr'):
+    # one pass over the stream, ignore very first value
+    sketch = ENGINES[engine]()
+    values = _open_values(lines)
+    next(values, None)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def _sketch_range(filename, start, end, engine):
+    # the first value is returned apart,
+    # only the caller knows whether it is the very first `open` of the file
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        values = _open_values(io.BytesIO(file.read(end - start)))
+
+    first_value = next(values, None)
+    sketch = ENGINES[engine]()
+    for value in values:
+        sketch.add(value)
+    return first_value, sketch
+
+
+def collect_parallel(filename, engine='hdr', workers=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    with open(filename, 'rb') as file:
+        if file.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            raise ValueError('Parallel mode needs an uncompressed file: {}'.format(filename))
+        ranges = chunk_offsets(file, chunk_size)
+
+    sketch = ENGINES[engine]()
+    seen_first = False
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_sketch_range, filename, start, end, engine) for start, end in ranges]
+
+        for future in futures:
+            first_value, chunk_sketch = future.result()
+            if first_value is not None:
+                if seen_first:
+                    sketch.add(first_value)
+                seen_first = True
+            sketch.merge(chunk_sketch)
+
+    return sketch
+
+
+def follow(filename, windows=FOLLOW_WINDOWS, report_interval=1.0):
+    # only lines written after the start are seen, so no value is ignored here
+    rolling = RollingWindows(LogHistogram, windows)
+    next_report = time.monotonic() + report_interval
+
+    for line in follow_lines(filename):
+        now = time.monotonic()
+        value = parse_open(line) if line is not None else None
+        if value is not None:
+            rolling.add(value, now)
+
+        if now >= next_report:
+            print(time.strftime('%H:%M:%S'))
+            for seconds in windows:
+                window = rolling.window(seconds, now)
+                if window.count:
+                    print('{:>3}: count = {}, mean = {:.1f}, std = {:.1f}, upper decile = {}'.format(
+                        '{}m'.format(seconds // 60), window.count,
+                        window.mean, window.std, window.quantile(0.9)))
+            print(flush=True)
+            next_report = now + report_interval
+
+
+class TestSketches(unittest.TestCase):
+    QS = (0.5, 0.9, 0.99, 0.999)
+
+    def setUp(self):
+        random.seed(7)
+        self.values = [int(random.lognormvariate(8, 2)) for _ in range(20000)]
+        self.sorted_values = sorted(self.values)
 
-    with open(sys.argv[1]) as file:
-        count = len([line for line in _skip_first_occurrence(file, 'open') if line.startswith('open')])
-        heap_size = int(math.ceil(count / 10))
+    def test_rank_matches_decile_heap(self):
+        for count in range(1, 60):
+            values = random.sample(range(1000), count)
+            heap_top = heapq.nlargest(math.ceil(count / 10), values)[-1]
+            self.assertEqual(sorted(values)[quantile_rank(0.9, count)], heap_top)
 
-        heap = [0] * heap_size
+    def test_log_histogram_relative_error(self):
+        histogram = LogHistogram()
+        for value in self.values:
+            histogram.add(value)
 
-        file.seek(0)
-        _skip_first_occurrence(file, 'open')
+        for q in self.QS:
+            expected = self.sorted_values[quantile_rank(q, len(self.values))]
+            self.assertLessEqual(abs(histogram.quantile(q) - expected), expected * 2 ** -11)
 
-        for line in file:
-            if not line.startswith('open'):
-                continue
+    def test_log_histogram_small_values_exact(self):
+        histogram = LogHistogram()
+        for value in range(2048):
+            histogram.add(value)
+        self.assertEqual(histogram.quantiles([0, 0.5, 1]), [0, 1024, 2047])
 
-            current_value = int(line.split()[2])
+    def test_log_histogram_merge(self):
+        whole, first, second = LogHistogram(), LogHistogram(), LogHistogram()
+        for i, value in enumerate(self.values):
+            whole.add(value)
+            (first if i % 3 else second).add(value)
 
-            if current_value > heap[0]:
-                heapq.heappushpop(heap, current_value)
+        merged = first.merge(second)
+        self.assertEqual(merged.quantiles(self.QS), whole.quantiles(self.QS))
+        self.assertEqual((merged.count, merged.total, merged.min, merged.max),
+                         (whole.count, whole.total, whole.min, whole.max))
 
-    print(f'upper decile = {heap[0]}')
+    def _assert_kll_rank_error(self, sketch):
+        count = len(self.sorted_values)
+        for q in self.QS:
+            answer = sketch.quantile(q)
+            low = bisect.bisect_left(self.sorted_values, answer)
+            high = bisect.bisect_right(self.sorted_values, answer)
+            target = quantile_rank(q, count)
+            error = 0 if low <= target < high else min(abs(low - target), abs(high - 1 - target))
+            self.assertLessEqual(error / count, 0.0165)
+
+    def test_kll_rank_error(self):
+        sketch = KllSketch()
+        for value in self.values:
+            sketch.add(value)
+        self.assertEqual(sketch.count, len(self.values))
+        # capacities sum to k * (1 + c + c ** 2 + ...) + levels <= 3 * k + levels
+        self.assertLess(sum(map(len, sketch._compactors)), 3 * sketch.k + len(sketch._compactors))
+        self._assert_kll_rank_error(sketch)
+
+    def test_kll_merge(self):
+        parts = [KllSketch() for _ in range(4)]
+        for i, value in enumerate(self.values):
+            parts[i % 4].add(value)
+
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        self.assertEqual(merged.count, len(self.values))
+        self._assert_kll_rank_error(merged)
+
+    def test_open_log_gzip_and_stdin(self):
+        log = b'header\nopen a 1 usec\nopen b 5 usec\nread c 9 usec\nopen d 7 usec\n'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log.gz')
+            with gzip.open(path, 'wb') as file:
+                file.write(log)
+            with open_log(path) as file:
+                self.assertEqual(collect(file, 'exact').quantiles([0, 1]), [5, 7])
+
+        for data in (log, gzip.compress(log)):
+            stdin = mock.Mock(buffer=io.BufferedReader(io.BytesIO(data)))
+            with mock.patch.object(sys, 'stdin', stdin):
+                with open_log('-') as file:
+                    self.assertEqual(collect(file, 'hdr').quantiles([0, 1]), [5, 7])
+
+
+class TestExactValues(unittest.TestCase):
+    QS = (0, 0.5, 0.9, 0.99, 0.999, 1)
+
+    def _check(self, values):
+        expected = sorted(values)
+        ranks = [quantile_rank(q, len(values)) for q in self.QS]
+
+        self.assertEqual(select(array.array('q', values), ranks), [expected[r] for r in ranks])
+
+        for backend in (numpy, None):
+            with mock.patch.object(sys.modules[__name__], 'numpy', backend):
+                exact = ExactValues()
+                for value in values:
+                    exact.add(value)
+                self.assertEqual(exact.quantiles(self.QS), [expected[r] for r in ranks])
+
+    def test_random(self):
+        generator = random.Random(1)
+        self._check([generator.randrange(10 ** 6) for _ in range(5000)])
+
+    def test_duplicates(self):
+        generator = random.Random(2)
+        self._check([generator.randrange(3) for _ in range(5000)])
+        self._check([7] * 100)
+
+    def test_sorted(self):
+        self._check(list(range(3000)))
+        self._check(list(range(3000, 0, -1)))
+
+    def test_tiny(self):
+        self._check([5])
+        self._check([9, 4])
+
+    def test_empty(self):
+        self.assertEqual(ExactValues().quantiles([0.5]), [None])
+
+    def test_widening(self):
+        values = [1, 2 ** 32, 3, 2 ** 40 + 1, 0]
+        exact = ExactValues()
+        for value in values:
+            exact.add(value)
+        self.assertEqual(exact._values.typecode, 'q')
+        self.assertEqual(exact.quantile(1), 2 ** 40 + 1)
+        self._check(values)
+
+    def test_merge_widens(self):
+        small, large = ExactValues(), ExactValues()
+        small.add(1)
+        large.add(2 ** 33)
+        self.assertEqual(small.merge(large).quantiles([0, 1]), [1, 2 ** 33])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Percentiles of open latencies in one pass')
+    parser.add_argument('filename', nargs='?', help="log file, plain or gzip, '-' for stdin")
+    parser.add_argument('-p', '--percentiles', type=float, nargs='+', default=DEFAULT_PERCENTILES)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='hdr',
+                        help='hdr: log-bucketed histogram, exact below 2048 usec and within 0.05%% above; '
+                             'kll: KLL sketch, fixed memory, about 1.65%% rank error; '
+                             'exact: every value in a compact array, 4-8 bytes per sample')
+    parser.add_argument('--workers', type=int, help='parse newline-aligned chunks in a process pool')
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help='keep reading a growing log like tail -F, printing 1m/5m/15m windows')
+    args = parser.parse_args()
+
+    if args.filename is None:
+        print('filename was not provided', file=sys.stderr)
+        sys.exit(-1)
+
+    if args.follow:
+        try:
+            follow(args.filename)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    try:
+        if args.workers:
+            sketch = collect_parallel(args.filename, args.engine, args.workers)
+        else:
+            with open_log(args.filename) as file:
+                sketch = collect(file, args.engine)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(-1)
 
+    if sketch.count == 0:
+        print('sample is empty')
+        sys.exit(0)
 
+    values = sketch.quantiles([percentile / 100 for percentile in args.percentiles])
+    for percentile, value in zip(args.percentiles, values):
+        print('p{:g} = {}'.format(percentile, value))